@@ -0,0 +1,320 @@
+"""
+结构化日志管道
+
+- 请求级上下文：RequestIdMiddleware 为每个请求分配 request_id（或沿用请求头 X-Request-ID），
+  并通过 contextvars 让同一请求内的日志自动带上 request_id / user_id。
+- 非阻塞写入：日志记录只追加到内存环形缓冲区，请求处理路径上没有任何 I/O。
+- 批量落盘：后台任务定期把缓冲区按批写入 SystemLog 表、JSON Lines 文件或控制台。
+- 负载采样：缓冲区超过高水位时，INFO/DEBUG 级别按比例采样，WARNING/ERROR 始终保留。
+"""
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from collections import deque
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from models import SystemLog, create_tables, get_session_maker
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+# 结构化日志的核心字段，附加字段同名时会加上 extra_ 前缀
+RESERVED_FIELDS = {"ts", "level", "module", "request_id", "user_id", "message"}
+
+_request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+_user_id_var: ContextVar[Optional[str]] = ContextVar("user_id", default=None)
+
+
+def _env_number(name: str, default, cast=int, minimum=None, maximum=None, exclusive_minimum=False):
+    """读取数值型配置，无效或越界时回退到默认值并在 stderr 给出警告"""
+    raw = os.getenv(name)
+    if raw is None or raw.strip() == "":
+        return default
+    try:
+        value = cast(raw)
+    except ValueError:
+        print(f"日志配置 {name}={raw!r} 无效，使用默认值 {default}", file=sys.stderr)
+        return default
+    too_small = minimum is not None and (value <= minimum if exclusive_minimum else value < minimum)
+    too_large = maximum is not None and value > maximum
+    if too_small or too_large:
+        print(f"日志配置 {name}={raw!r} 超出范围，使用默认值 {default}", file=sys.stderr)
+        return default
+    return value
+
+
+def get_request_id() -> Optional[str]:
+    """获取当前请求的 request_id"""
+    return _request_id_var.get()
+
+
+def set_user_id(user_id: Optional[str]):
+    """为当前请求绑定 user_id，之后的日志会自动带上"""
+    _user_id_var.set(user_id)
+
+
+@dataclass
+class LogRecord:
+    """结构化日志记录"""
+    level: str
+    message: str
+    module: Optional[str] = None
+    user_id: Optional[str] = None
+    request_id: Optional[str] = None
+    created_at: datetime = field(default_factory=datetime.utcnow)
+    extra: Dict = field(default_factory=dict)
+
+    def to_dict(self) -> Dict:
+        return {
+            **self.extra,
+            "ts": self.created_at.isoformat(),
+            "level": self.level,
+            "module": self.module,
+            "request_id": self.request_id,
+            "user_id": self.user_id,
+            "message": self.message
+        }
+
+
+class LogPipeline:
+    """内存环形缓冲 + 后台批量写入的日志管道"""
+
+    def __init__(self):
+        self.min_level = LEVELS.get(os.getenv("LOG_LEVEL", "INFO").upper(), LEVELS["INFO"])
+        self.sinks = [s.strip() for s in os.getenv("LOG_SINKS", "console,db").split(",") if s.strip()]
+        self.jsonl_path = os.getenv("LOG_JSONL_PATH", "./system_logs.jsonl")
+        self.capacity = _env_number("LOG_BUFFER_SIZE", 10000, minimum=1)
+        self.batch_size = _env_number("LOG_BATCH_SIZE", 500, minimum=1)
+        self.flush_interval = _env_number("LOG_FLUSH_INTERVAL", 1.0, cast=float, minimum=0, exclusive_minimum=True)
+        # 缓冲区占用超过该比例时开始对低级别日志采样
+        watermark = _env_number("LOG_SAMPLE_WATERMARK", 0.5, cast=float, minimum=0, maximum=1)
+        self.high_watermark = int(self.capacity * watermark)
+        self.sample_rate = _env_number("LOG_SAMPLE_RATE", 0.1, cast=float, minimum=0, maximum=1)
+
+        # deque 满时自动丢弃最旧的记录，append 永不阻塞
+        self._buffer: deque = deque(maxlen=self.capacity)
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._session_maker = None
+        self.dropped = 0
+        self.sampled_out = 0
+
+    def log(self, level: str, message: str, module: Optional[str] = None, extra: Optional[Dict] = None):
+        """追加一条日志记录（不做任何 I/O）"""
+        levelno = LEVELS.get(level, LEVELS["INFO"])
+        if levelno < self.min_level:
+            return
+
+        size = len(self._buffer)
+        if levelno < LEVELS["WARNING"] and size >= self.high_watermark and random.random() >= self.sample_rate:
+            self.sampled_out += 1
+            return
+        if size >= self.capacity:
+            self.dropped += 1
+
+        self._buffer.append(LogRecord(
+            level=level,
+            message=message,
+            module=module,
+            user_id=_user_id_var.get(),
+            request_id=_request_id_var.get(),
+            extra={f"extra_{k}" if k in RESERVED_FIELDS else k: v for k, v in extra.items()} if extra else {}
+        ))
+
+    def get_logger(self, module: str) -> "ModuleLogger":
+        return ModuleLogger(self, module)
+
+    async def start(self):
+        """启动后台写入任务"""
+        if self._task is not None:
+            return
+        if "db" in self.sinks:
+            try:
+                await asyncio.to_thread(self._init_db)
+            except Exception as e:
+                print(f"日志数据库初始化失败，停用数据库写入: {e}", file=sys.stderr)
+                self.sinks.remove("db")
+        # 在事件循环内创建，避免绑定到其他循环
+        self._stopping = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """通知后台任务退出并等待其写完剩余日志"""
+        if self._task is None:
+            await self.flush()
+            return
+        self._stopping.set()
+        await self._task
+        self._task = None
+        # 后台任务可能在写出最后一批之前就已退出循环
+        await self.flush()
+
+    async def flush(self):
+        """把缓冲区中的日志按批写出，同一时间只有一个写入线程"""
+        if self._flush_lock is None:
+            await self._flush()
+            return
+        async with self._flush_lock:
+            await self._flush()
+
+    async def _flush(self):
+        self._report_overload()
+        while self._buffer:
+            batch = self._drain()
+            await asyncio.to_thread(self._write_batch, batch)
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def _report_overload(self):
+        """把上次写出以来被丢弃和采样掉的日志数量作为 WARNING 记录写出"""
+        if not self.dropped and not self.sampled_out:
+            return
+        dropped, sampled_out = self.dropped, self.sampled_out
+        self.dropped = 0
+        self.sampled_out = 0
+        self._buffer.append(LogRecord(
+            level="WARNING",
+            message="日志缓冲区过载，部分日志未写出",
+            module="log_pipeline",
+            extra={"dropped": dropped, "sampled_out": sampled_out}
+        ))
+
+    def _drain(self) -> List[LogRecord]:
+        batch = []
+        while self._buffer and len(batch) < self.batch_size:
+            batch.append(self._buffer.popleft())
+        return batch
+
+    def _init_db(self):
+        create_tables()
+        self._session_maker = get_session_maker()
+
+    def _write_batch(self, batch: List[LogRecord]):
+        """在线程池中执行，各写入目标互不影响"""
+        for sink in self.sinks:
+            try:
+                if sink == "db":
+                    self._write_db(batch)
+                elif sink == "jsonl":
+                    self._write_jsonl(batch)
+                elif sink == "console":
+                    self._write_console(batch)
+            except Exception as e:
+                print(f"日志写入 {sink} 失败: {e}", file=sys.stderr)
+
+    def _write_db(self, batch: List[LogRecord]):
+        db = self._session_maker()
+        try:
+            db.add_all([
+                SystemLog(
+                    log_level=record.level,
+                    message=record.message if not record.extra else
+                    f"{record.message} {json.dumps(record.extra, ensure_ascii=False, default=str)}",
+                    module=(record.module or "")[:50] or None,
+                    user_id=(record.user_id or "")[:50] or None,
+                    request_id=record.request_id,
+                    created_at=record.created_at
+                )
+                for record in batch
+            ])
+            db.commit()
+        finally:
+            db.close()
+
+    def _write_jsonl(self, batch: List[LogRecord]):
+        lines = [json.dumps(record.to_dict(), ensure_ascii=False, default=str) for record in batch]
+        with open(self.jsonl_path, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def _write_console(self, batch: List[LogRecord]):
+        lines = []
+        for record in batch:
+            extra = " ".join(f"{k}={v}" for k, v in record.extra.items())
+            lines.append(
+                f"{record.created_at.isoformat(timespec='milliseconds')} {record.level} "
+                f"[{record.module or '-'}] [{record.request_id or '-'}] {record.message}"
+                + (f" {extra}" if extra else "")
+            )
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+
+
+class ModuleLogger:
+    """绑定模块名的日志接口"""
+
+    def __init__(self, pipeline: LogPipeline, module: str):
+        self.pipeline = pipeline
+        self.module = module
+
+    def debug(self, message: str, /, **extra):
+        self.pipeline.log("DEBUG", message, self.module, extra)
+
+    def info(self, message: str, /, **extra):
+        self.pipeline.log("INFO", message, self.module, extra)
+
+    def warning(self, message: str, /, **extra):
+        self.pipeline.log("WARNING", message, self.module, extra)
+
+    def error(self, message: str, /, **extra):
+        self.pipeline.log("ERROR", message, self.module, extra)
+
+
+class RequestIdMiddleware:
+    """纯 ASGI 中间件：分配 request_id、回写 X-Request-ID 响应头并记录访问日志"""
+
+    def __init__(self, app, pipeline: "LogPipeline" = None):
+        self.app = app
+        self.logger = (pipeline or log_pipeline).get_logger("http")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope.get("headers", []):
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:100]
+                break
+        request_id = request_id or uuid.uuid4().hex
+
+        request_token = _request_id_var.set(request_id)
+        user_token = _user_id_var.set(None)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.logger.info(
+                f"{scope['method']} {scope['path']}",
+                status=status,
+                duration_ms=round((time.perf_counter() - start) * 1000, 2)
+            )
+            _user_id_var.reset(user_token)
+            _request_id_var.reset(request_token)
+
+
+# 全局日志管道
+log_pipeline = LogPipeline()
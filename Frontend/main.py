@@ -9,12 +9,29 @@ from camel.models import ModelFactory
 from camel.types import ModelPlatformType, ModelType
 from camel.configs import ChatGPTConfig
 import os
+import time
 from dotenv import load_dotenv
 
-# 加载环境变量
+# 加载环境变量（需在导入 log_pipeline 之前，日志管道在导入时读取配置）
 load_dotenv()
 
+from replay import (
+    TranscriptRecorder, create_replay_agents, get_transcript_mode, get_transcript_path, load_transcript, transcript_files
+)
+from log_pipeline import RequestIdMiddleware, log_pipeline, set_user_id
+
 app = FastAPI(title="多智能体标签协同系统", version="1.0.0")
+app.add_middleware(RequestIdMiddleware, pipeline=log_pipeline)
+
+logger = log_pipeline.get_logger("analyzer")
+
+@app.on_event("startup")
+async def start_log_pipeline():
+    await log_pipeline.start()
+
+@app.on_event("shutdown")
+async def stop_log_pipeline():
+    await log_pipeline.stop()
 
 # 数据模型
 class TagData(BaseModel):
@@ -65,18 +82,38 @@ class MultiAgentTagAnalyzer:
         # 检查是否启用模拟模式
         self.simulation_mode = os.getenv("SIMULATION_MODE", "true").lower() == "true"
 
-        # 创建不同角色的智能体（如果不是模拟模式）
-        if not self.simulation_mode:
+        # LLM 调用记录/回放模式
+        self.transcript_mode = get_transcript_mode()
+        self.recorder = None
+
+        # 创建不同角色的智能体（回放模式使用记录日志中的回复，否则在非模拟模式下创建）
+        if self.transcript_mode == "replay":
+            self.agents = self._create_replay_agents()
+            if self.agents is None:
+                self.transcript_mode = None
+                self.simulation_mode = True
+            else:
+                self.simulation_mode = False
+        elif not self.simulation_mode:
             try:
                 self.agents = self._create_agents()
             except Exception as e:
-                print(f"创建智能体失败，切换到模拟模式: {e}")
+                logger.warning(f"创建智能体失败，切换到模拟模式: {e}")
                 self.simulation_mode = True
                 self.agents = None
         else:
-            print("运行在模拟模式下")
+            logger.info("运行在模拟模式下")
             self.agents = None
 
+        # 记录模式只在调用真实智能体时有意义
+        if self.transcript_mode == "record":
+            if self.simulation_mode:
+                logger.warning("记录模式需要 SIMULATION_MODE=false，模拟模式下不记录 LLM 调用")
+                self.transcript_mode = None
+            else:
+                self.recorder = TranscriptRecorder(get_transcript_path())
+                logger.info("运行在记录模式下", transcript_path=get_transcript_path())
+
     def _create_agents(self):
         """创建不同角色的智能体"""
         model = ModelFactory.create(
@@ -90,9 +127,62 @@ class MultiAgentTagAnalyzer:
 
         return agents
 
+    def _create_replay_agents(self):
+        """根据记录日志创建回放智能体，配置无效时返回 None"""
+        path = get_transcript_path()
+        try:
+            speed = float(os.getenv("TRANSCRIPT_SPEED", "1.0"))
+        except ValueError:
+            logger.error(f"TRANSCRIPT_SPEED 配置无效: {os.getenv('TRANSCRIPT_SPEED')}，切换到模拟模式")
+            return None
+
+        if not transcript_files(path):
+            logger.error(f"回放记录日志不存在: {path}，切换到模拟模式")
+            return None
+
+        try:
+            agents = create_replay_agents(load_transcript(path), speed=speed)
+        except Exception as e:
+            logger.error(f"读取回放记录日志失败，切换到模拟模式: {e}")
+            return None
+
+        logger.info("运行在回放模式下", transcript_path=path)
+        return agents
+
+    def _step_agent(self, agent_name: str, stage: str, message: BaseMessage):
+        """调用智能体，记录模式下保存 prompt、原始回复（或异常）和耗时"""
+        start = time.perf_counter()
+        try:
+            response = self.agents[agent_name].step(message)
+        except Exception as e:
+            if self.recorder is not None:
+                self.recorder.record_step(
+                    stage=stage,
+                    agent_name=agent_name,
+                    role_name=message.role_name,
+                    prompt=message.content,
+                    content=None,
+                    latency=time.perf_counter() - start,
+                    error=str(e)
+                )
+            raise
+        if self.recorder is not None:
+            self.recorder.record_step(
+                stage=stage,
+                agent_name=agent_name,
+                role_name=message.role_name,
+                prompt=message.content,
+                content=response.msg.content,
+                latency=time.perf_counter() - start
+            )
+        return response
+
     async def analyze_tags(self, user_profile: UserProfile, max_tags: int = 10) -> AnalysisResponse:
         """多智能体协同分析标签"""
         try:
+            if self.recorder is not None:
+                self.recorder.record_request(user_profile.model_dump(), max_tags)
+
             # 准备分析数据
             tags_info = self._prepare_tags_info(user_profile)
 
@@ -137,7 +227,7 @@ class MultiAgentTagAnalyzer:
 
         analyses = {}
 
-        for agent_name, agent in self.agents.items():
+        for agent_name in self.agents:
             prompt = f"""
 请分析以下用户的标签数据，从你的专业角度评估每个标签的重要性：
 
@@ -163,7 +253,7 @@ class MultiAgentTagAnalyzer:
             """
 
             try:
-                response = agent.step(BaseMessage.make_user_message(
+                response = self._step_agent(agent_name, "individual", BaseMessage.make_user_message(
                     role_name="用户",
                     content=prompt
                 ))
@@ -206,7 +296,7 @@ class MultiAgentTagAnalyzer:
                 }
 
             except Exception as e:
-                print(f"智能体 {agent_name} 分析失败: {e}")
+                logger.error(f"智能体 {agent_name} 分析失败: {e}", agent=agent_name)
                 analyses[agent_name] = {
                     "raw_response": f"分析失败: {str(e)}",
                     "parsed_analysis": {"analysis": [], "overall_assessment": "分析失败"}
@@ -244,7 +334,7 @@ class MultiAgentTagAnalyzer:
 
         # 使用分析师智能体进行最终协商
         try:
-            response = self.agents["analyst"].step(BaseMessage.make_user_message(
+            response = self._step_agent("analyst", "consensus", BaseMessage.make_user_message(
                 role_name="协调员",
                 content=discussion_prompt
             ))
@@ -260,7 +350,7 @@ class MultiAgentTagAnalyzer:
             consensus = json.loads(json_content)
 
         except Exception as e:
-            print(f"协商讨论失败: {e}")
+            logger.error(f"协商讨论失败: {e}")
             consensus = {"selected_tags": [], "discussion_summary": "协商失败"}
 
         return {
@@ -450,7 +540,7 @@ class MultiAgentTagAnalyzer:
             )
 
         except Exception as e:
-            print(f"生成最终结果失败: {e}")
+            logger.error(f"生成最终结果失败: {e}")
             # 返回备用结果
             return AnalysisResponse(
                 user_id=user_profile.user_id,
@@ -493,6 +583,7 @@ async def analyze_user_tags(request: TagAnalysisRequest):
     通过多智能体协同讨论，从不同专业角度分析用户标签，
     筛选出最重要的标签并确定优先级。
     """
+    set_user_id(request.user_profile.user_id)
     try:
         result = await analyzer.analyze_tags(
             user_profile=request.user_profile,
@@ -513,6 +604,7 @@ async def analyze_simple_tags(request: SimpleTagAnalysisRequest):
     这是一个简化的接口，只需要传入标签文字列表，
     系统会自动创建用户档案并进行多智能体分析。
     """
+    set_user_id(request.user_id)
     try:
         # 从字符串列表创建用户档案
         user_profile = analyzer.create_user_profile_from_tags(
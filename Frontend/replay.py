@@ -0,0 +1,272 @@
+"""
+LLM 调用记录与离线回放工具
+
+- 记录模式 (TRANSCRIPT_MODE=record)：把每次分析请求、每次智能体调用的 prompt、
+  原始 response.msg.content 以及耗时写入紧凑的 JSON Lines 日志（.gz 结尾时 gzip 压缩）。
+  每个进程写入独立的分段文件 <名称>-<时间>-<pid>.jsonl.gz，回放时按文件名顺序读取全部分段。
+- 回放模式 (TRANSCRIPT_MODE=replay)：用本地假模型按原始顺序、原始耗时返回记录的内容，
+  无需访问 OpenAI 即可复现解析、协商和序列化逻辑。
+
+命令行用法（离线剖析）：
+    python replay.py transcripts.jsonl.gz --profile --speed 0
+"""
+import argparse
+import atexit
+import cProfile
+import glob
+import gzip
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import zlib
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional
+
+
+def _open_log(path: str, mode: str):
+    """按扩展名打开日志文件（.gz 使用 gzip）"""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def _split_log_name(path: str):
+    """拆分日志路径为 (前缀, 扩展名)，扩展名保留 .jsonl.gz 这样的双后缀"""
+    for ext in (".jsonl.gz", ".jsonl"):
+        if path.endswith(ext):
+            return path[:-len(ext)], ext
+    return os.path.splitext(path)
+
+
+def transcript_files(path: str) -> List[str]:
+    """返回 TRANSCRIPT_PATH 对应的全部记录文件：路径本身（如存在）加上各进程的分段文件"""
+    base, ext = _split_log_name(path)
+    files = [path] if os.path.isfile(path) else []
+    files += sorted(glob.glob(f"{glob.escape(base)}-*{glob.escape(ext)}"))
+    return files
+
+
+def _load_file(path: str, entries: List[Dict]):
+    with _open_log(path, "r") as f:
+        try:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # 进程异常退出时最后一行可能不完整
+                    break
+        except (EOFError, OSError, zlib.error) as e:
+            # gzip 文件未正常关闭或已损坏，保留已读出的条目
+            print(f"记录日志 {path} 不完整或已损坏，保留此前读出的条目: {e}", file=sys.stderr)
+
+
+def load_transcript(path: str) -> List[Dict]:
+    """读取记录日志（含所有分段文件），返回条目列表"""
+    entries = []
+    for file_path in transcript_files(path):
+        _load_file(file_path, entries)
+    return entries
+
+
+class TranscriptRecorder:
+    """把分析请求与智能体调用追加写入日志"""
+
+    def __init__(self, path: str):
+        # 每个进程写入独立的分段文件，避免多个 worker 或重启后追加到同一个 gzip 文件
+        base, ext = _split_log_name(path)
+        self.path = f"{base}-{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}{ext}"
+        self._lock = threading.Lock()
+        # 整个生命周期共用一个文件句柄，gzip 压缩可以跨行生效
+        self._file = None
+        atexit.register(self.close)
+
+    def _write(self, entry: Dict):
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            if self._file is None:
+                self._file = _open_log(self.path, "a")
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        """关闭日志文件，写出 gzip 结尾"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def record_request(self, user_profile: Dict, max_tags: int):
+        """记录一次分析请求，回放时用于重建输入"""
+        self._write({
+            "kind": "request",
+            "ts": time.time(),
+            "user_profile": user_profile,
+            "max_tags": max_tags
+        })
+
+    def record_step(self, stage: str, agent_name: str, role_name: str, prompt: str, content: Optional[str],
+                    latency: float, error: Optional[str] = None):
+        """记录一次智能体调用，调用失败时 content 为空并记录 error"""
+        entry = {
+            "kind": "step",
+            "ts": time.time(),
+            "stage": stage,
+            "agent": agent_name,
+            "role": role_name,
+            "prompt": prompt,
+            "content": content,
+            "latency": round(latency, 4)
+        }
+        if error is not None:
+            entry["error"] = error
+        self._write(entry)
+
+
+@dataclass
+class _ReplayMessage:
+    content: str
+
+
+@dataclass
+class _ReplayResponse:
+    msg: _ReplayMessage
+
+
+class ReplayAgent:
+    """本地假模型：按记录顺序返回原始回复，并模拟原始耗时"""
+
+    def __init__(self, agent_name: str, steps: Deque[Dict], speed: float = 1.0):
+        self.agent_name = agent_name
+        self.steps = steps
+        self.speed = speed
+        self.prompt_mismatches = 0
+
+    def step(self, message) -> _ReplayResponse:
+        if not self.steps:
+            raise RuntimeError(f"智能体 {self.agent_name} 的回放记录已耗尽")
+
+        entry = self.steps.popleft()
+        if entry.get("prompt") != getattr(message, "content", None):
+            self.prompt_mismatches += 1
+
+        # 与真实 agent.step 一样是同步阻塞调用
+        if self.speed > 0:
+            time.sleep(entry.get("latency", 0.0) * self.speed)
+
+        # 复现记录时模型调用抛出的异常
+        if "error" in entry:
+            raise RuntimeError(entry["error"])
+
+        return _ReplayResponse(msg=_ReplayMessage(content=entry["content"]))
+
+
+def create_replay_agents(entries: List[Dict], speed: float = 1.0) -> Dict[str, ReplayAgent]:
+    """根据记录日志为每个智能体创建回放代理"""
+    steps: Dict[str, Deque[Dict]] = defaultdict(deque)
+    for entry in entries:
+        if entry.get("kind") == "step":
+            steps[entry["agent"]].append(entry)
+
+    return {name: ReplayAgent(name, queue, speed) for name, queue in steps.items()}
+
+
+def get_transcript_mode() -> Optional[str]:
+    """读取 TRANSCRIPT_MODE 环境变量，返回 record / replay / None"""
+    mode = os.getenv("TRANSCRIPT_MODE", "").strip().lower()
+    return mode if mode in ("record", "replay") else None
+
+
+def get_transcript_path() -> str:
+    """读取 TRANSCRIPT_PATH 环境变量"""
+    return os.getenv("TRANSCRIPT_PATH", "./transcripts.jsonl.gz")
+
+
+async def _replay_all(analyzer, requests: List[Dict]) -> List[float]:
+    """依次回放所有请求，返回每个请求的耗时（含结果序列化）"""
+    from main import UserProfile
+    from log_pipeline import log_pipeline
+
+    # 启动日志管道，确保解析、协商失败等日志在回放时输出
+    await log_pipeline.start()
+    timings = []
+    try:
+        for entry in requests:
+            start = time.perf_counter()
+            result = await analyzer.analyze_tags(
+                user_profile=UserProfile(**entry["user_profile"]),
+                max_tags=entry["max_tags"]
+            )
+            result.model_dump_json()
+            timings.append(time.perf_counter() - start)
+    finally:
+        await log_pipeline.stop()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线回放记录的 LLM 调用并剖析热点")
+    parser.add_argument("path", nargs="?", default=get_transcript_path(), help="记录日志路径")
+    parser.add_argument("--speed", type=float, default=1.0, help="耗时倍率，0 表示不等待")
+    parser.add_argument("--profile", action="store_true", help="使用 cProfile 输出热点报告")
+    parser.add_argument("--sort", default="cumulative", help="热点报告排序字段，如 cumulative / tottime")
+    parser.add_argument("--top", type=int, default=30, help="热点报告显示的函数数量")
+    parser.add_argument("--output", help="保存 cProfile 原始数据的路径（可用 snakeviz 等工具查看）")
+    args = parser.parse_args()
+
+    if not transcript_files(args.path):
+        print(f"记录日志不存在: {args.path}", file=sys.stderr)
+        sys.exit(1)
+
+    # main 在导入时创建全局分析器，需先设置回放相关环境变量
+    os.environ["SIMULATION_MODE"] = "false"
+    os.environ["TRANSCRIPT_MODE"] = "replay"
+    os.environ["TRANSCRIPT_PATH"] = args.path
+    os.environ["TRANSCRIPT_SPEED"] = str(args.speed)
+    # 离线回放默认只把日志输出到控制台
+    os.environ.setdefault("LOG_SINKS", "console")
+
+    import asyncio
+    from main import analyzer
+
+    # 记录日志无法使用时分析器会回退到模拟模式，此时剖析结果没有意义
+    if analyzer.transcript_mode != "replay":
+        from log_pipeline import log_pipeline
+        asyncio.run(log_pipeline.flush())
+        print(f"无法以回放模式加载记录日志: {args.path}，详见上方日志", file=sys.stderr)
+        sys.exit(1)
+
+    requests = [e for e in load_transcript(args.path) if e.get("kind") == "request"]
+    if not requests:
+        print(f"记录日志中没有分析请求: {args.path}", file=sys.stderr)
+        sys.exit(1)
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    timings = asyncio.run(_replay_all(analyzer, requests))
+    if profiler:
+        profiler.disable()
+
+    total = sum(timings)
+    print(f"回放请求数: {len(timings)}, 总耗时: {total:.3f}s, 平均: {total / len(timings):.3f}s, 最大: {max(timings):.3f}s")
+    mismatches = sum(agent.prompt_mismatches for agent in analyzer.agents.values())
+    if mismatches:
+        print(f"警告: {mismatches} 次调用的 prompt 与记录不一致")
+
+    if profiler:
+        if args.output:
+            profiler.dump_stats(args.output)
+            print(f"cProfile 数据已保存: {args.output}")
+        stats = pstats.Stats(profiler)
+        stats.strip_dirs().sort_stats(args.sort).print_stats(args.top)
+
+
+if __name__ == "__main__":
+    main()
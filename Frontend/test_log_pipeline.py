@@ -0,0 +1,117 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from log_pipeline import LogPipeline
+
+
+def make_pipeline(jsonl_path: str, **env) -> LogPipeline:
+    """创建只写 JSON Lines 的日志管道，env 覆盖 LOG_* 配置"""
+    settings = {"LOG_SINKS": "jsonl", "LOG_JSONL_PATH": jsonl_path, "LOG_LEVEL": "DEBUG"}
+    settings.update(env)
+    with mock.patch.dict(os.environ, settings):
+        return LogPipeline()
+
+
+def read_jsonl(path: str):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class LogPipelineTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "logs.jsonl")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    async def test_stop_right_after_start_writes_buffered_records(self):
+        pipeline = make_pipeline(self.path, LOG_FLUSH_INTERVAL="60")
+        pipeline.log("ERROR", "协商讨论失败", "analyzer")
+        await pipeline.start()
+        await pipeline.stop()
+
+        records = read_jsonl(self.path)
+        self.assertEqual([r["message"] for r in records], ["协商讨论失败"])
+
+    async def test_invalid_settings_fall_back_to_defaults(self):
+        with mock.patch("sys.stderr"):
+            pipeline = make_pipeline(
+                self.path,
+                LOG_BATCH_SIZE="0",
+                LOG_BUFFER_SIZE="abc",
+                LOG_FLUSH_INTERVAL="-1",
+                LOG_SAMPLE_RATE="2"
+            )
+        self.assertEqual(pipeline.batch_size, 500)
+        self.assertEqual(pipeline.capacity, 10000)
+        self.assertEqual(pipeline.flush_interval, 1.0)
+        self.assertEqual(pipeline.sample_rate, 0.1)
+
+        pipeline.log("INFO", "hello")
+        await pipeline.start()
+        await pipeline.stop()
+        self.assertEqual(len(read_jsonl(self.path)), 1)
+
+    async def test_extra_fields_do_not_override_core_fields(self):
+        pipeline = make_pipeline(self.path)
+        logger = pipeline.get_logger("analyzer")
+        logger.info("原始消息", message="覆盖", module="other", level="x", agent="analyst")
+        await pipeline.stop()
+
+        record = read_jsonl(self.path)[0]
+        self.assertEqual(record["message"], "原始消息")
+        self.assertEqual(record["module"], "analyzer")
+        self.assertEqual(record["level"], "INFO")
+        self.assertEqual(record["extra_message"], "覆盖")
+        self.assertEqual(record["extra_module"], "other")
+        self.assertEqual(record["agent"], "analyst")
+
+    def test_full_buffer_drops_oldest_records(self):
+        pipeline = make_pipeline(self.path, LOG_BUFFER_SIZE="5")
+        for i in range(8):
+            pipeline.log("ERROR", f"m{i}")
+
+        self.assertEqual(pipeline.dropped, 3)
+        self.assertEqual([r.message for r in pipeline._buffer], ["m3", "m4", "m5", "m6", "m7"])
+
+    def test_low_levels_are_sampled_above_watermark(self):
+        pipeline = make_pipeline(self.path, LOG_BUFFER_SIZE="10", LOG_SAMPLE_WATERMARK="0.5", LOG_SAMPLE_RATE="0")
+        for i in range(8):
+            pipeline.log("INFO", f"m{i}")
+        pipeline.log("DEBUG", "debug")
+        pipeline.log("WARNING", "warning")
+        pipeline.log("ERROR", "error")
+
+        self.assertEqual(pipeline.sampled_out, 4)
+        self.assertEqual(
+            [r.message for r in pipeline._buffer],
+            ["m0", "m1", "m2", "m3", "m4", "warning", "error"]
+        )
+
+    async def test_overload_counts_are_reported_and_reset_on_flush(self):
+        pipeline = make_pipeline(self.path, LOG_BUFFER_SIZE="4", LOG_SAMPLE_WATERMARK="0.5", LOG_SAMPLE_RATE="0")
+        for i in range(4):
+            pipeline.log("INFO", f"m{i}")
+        for i in range(3):
+            pipeline.log("ERROR", f"e{i}")
+        await pipeline.flush()
+
+        warnings = [r for r in read_jsonl(self.path) if r["level"] == "WARNING"]
+        self.assertEqual(len(warnings), 1)
+        self.assertEqual(warnings[0]["module"], "log_pipeline")
+        self.assertEqual(warnings[0]["sampled_out"], 2)
+        self.assertEqual(warnings[0]["dropped"], 1)
+        self.assertEqual((pipeline.dropped, pipeline.sampled_out), (0, 0))
+
+        await pipeline.flush()
+        self.assertEqual(len([r for r in read_jsonl(self.path) if r["level"] == "WARNING"]), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()